@@ -1,11 +1,129 @@
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
+from cachetools import TTLCache
 import httpx
+import orjson
 import re
+import string
+
+DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+}
+
+TIKWM_API_URL = "https://www.tikwm.com/api/"
+
+# Tempo de espera pela primeira consulta ao tikwm antes de disparar a segunda
+TIKWM_HEDGE_DELAY = 2.0
+
+TIKWM_HEADERS = {
+    "Accept": "application/json, text/javascript, */*; q=0.01",
+    "Accept-Language": "en-US,en;q=0.9",
+    "Referer": "https://www.tikwm.com/",
+}
+
+DOWNLOAD_HEADERS = {
+    "Referer": "https://www.tikwm.com/",
+}
+
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# Padroes compilados uma vez no import
+_VIDEO_ID_PATTERNS = [
+    re.compile(p, re.ASCII) for p in (
+        r'video/(\d+)',
+        r'photo/(\d+)',
+        r'/v/(\d+)',
+    )
+]
+
+class _FilenameTable(dict):
+    """Tabela para str.translate: qualquer caractere fora da tabela vira '_'"""
+
+    def __missing__(self, key):
+        # Nao grava a chave (como faria um defaultdict), entao a tabela nao cresce
+        return '_'
+
+_FILENAME_TABLE = _FilenameTable(
+    {ord(c): c for c in string.ascii_letters + string.digits + '_-'}
+)
 
-app = FastAPI(title="SSSTiik API")
+def _normalize_url(url: str) -> str:
+    # Links colados sem esquema (www.tiktok.com/..., vm.tiktok.com/...) viram https
+    return url if url[:8].lower().startswith(("http://", "https://")) else "https://" + url
+
+def _is_tiktok_host(url: str) -> bool:
+    host = urlsplit(url).hostname or ""
+    return host == "tiktok.com" or host.endswith(".tiktok.com")
+
+class TokenBucket:
+    """Limita a taxa de chamadas para um host (tokens por segundo)"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def has_token(self) -> bool:
+        """Indica se ha token livre agora, sem consumir e sem ninguem na fila"""
+        if self._lock.locked():
+            return False
+        elapsed = time.monotonic() - self.updated
+        return min(self.capacity, self.tokens + elapsed * self.rate) >= 1
+
+# Respostas JSON recentes por video_id (as URLs do CDN expiram, entao TTL curto)
+_VIDEO_CACHE = TTLCache(maxsize=10_000, ttl=300)
+# Falhas recentes do tikwm (video privado, limite de taxa): evita repetir a
+# consulta para a mesma URL por alguns segundos
+_FAILED_CACHE = TTLCache(maxsize=10_000, ttl=5)
+
+# Limites de chamadas simultaneas e de taxa para o tikwm
+_TIKWM_SEM = asyncio.Semaphore(16)
+_TIKWM_BUCKET = TokenBucket(rate=10, capacity=20)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Cliente HTTP compartilhado para a API do tikwm: reaproveita conexoes
+    # keep-alive e multiplexa chamadas simultaneas na mesma conexao via HTTP/2
+    app.state.client = httpx.AsyncClient(
+        timeout=15.0,
+        follow_redirects=True,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=50, keepalive_expiry=30),
+        http2=True,
+        headers=DEFAULT_HEADERS,
+    )
+    # Cliente separado em HTTP/1.1 para o proxy de /download: no HTTP/2 cada
+    # stream fica na janela de 64 KiB e todos os videos dividiriam uma conexao
+    app.state.download_client = httpx.AsyncClient(
+        timeout=120.0,
+        follow_redirects=True,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=50, keepalive_expiry=30),
+        headers=DEFAULT_HEADERS,
+    )
+    yield
+    await app.state.client.aclose()
+    await app.state.download_client.aclose()
+
+app = FastAPI(title="SSSTiik API", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # CORS
 app.add_middleware(
@@ -36,86 +154,150 @@ async def root():
 async def health():
     return {"status": "healthy"}
 
-async def get_tiktok_data(url: str) -> dict:
-    """Extrai dados do video usando tikwm.com API"""
+def extract_video_id(url: str):
+    """Extrai o ID numerico do video a partir da URL (None se nao achar)"""
+    # Caminho rapido para o formato mais comum: /@user/video/<id> (so no path,
+    # primeiro /video/, igual aos regexes abaixo)
+    path = urlsplit(url).path
+    if '/video/' in path:
+        candidate = path.split('/video/', 1)[1].split('/', 1)[0]
+        if candidate.isascii() and candidate.isdigit():
+            return candidate
     
-    # Limpar URL
-    if "vm.tiktok.com" in url or "vt.tiktok.com" in url:
-        async with httpx.AsyncClient(follow_redirects=True) as client:
-            response = await client.get(url)
-            url = str(response.url)
+    for pattern in _VIDEO_ID_PATTERNS:
+        match = pattern.search(url)
+        if match:
+            return match.group(1)
     
-    # Extrair video ID
-    patterns = [
-        r'video/(\d+)',
-        r'photo/(\d+)',
-        r'/v/(\d+)',
-    ]
+    if '@' in url and '/' in url:
+        parts = url.split('/')
+        for part in parts:
+            if part.isdigit() and len(part) > 10:
+                return part
     
-    video_id = None
-    for pattern in patterns:
-        match = re.search(pattern, url)
-        if match:
-            video_id = match.group(1)
-            break
+    return None
+
+async def fetch_via_tikwm(client: httpx.AsyncClient, url: str, started: asyncio.Event = None) -> dict:
+    """Consulta a API do tikwm.com e normaliza a resposta"""
+    async with _TIKWM_SEM:
+        await _TIKWM_BUCKET.acquire()
+        # Sinaliza que a chamada saiu da fila local e vai de fato ao tikwm
+        if started is not None:
+            started.set()
+        # params= escapa a URL do TikTok (?, &, %) em vez de concatenar na query
+        response = await client.get(
+            TIKWM_API_URL, params={"url": url}, headers=TIKWM_HEADERS, timeout=30.0
+        )
     
-    if not video_id:
-        if '@' in url and '/' in url:
-            parts = url.split('/')
-            for part in parts:
-                if part.isdigit() and len(part) > 10:
-                    video_id = part
-                    break
+    if response.status_code != 200:
+        raise HTTPException(status_code=500, detail="Erro ao conectar com servidor")
     
-    if not video_id:
-        raise HTTPException(status_code=400, detail="Nao foi possivel extrair o ID do video")
+    # Parse direto dos bytes, sem decodificar o corpo inteiro para str
+    try:
+        data = orjson.loads(response.content)
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=500, detail="Resposta invalida do servidor")
     
-    api_url = f"https://www.tikwm.com/api/?url={url}"
+    if data.get("code") != 0:
+        raise HTTPException(status_code=400, detail="Video nao encontrado ou privado")
     
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-        "Accept": "application/json, text/javascript, */*; q=0.01",
-        "Accept-Language": "en-US,en;q=0.9",
-        "Referer": "https://www.tikwm.com/",
-    }
+    video_data = data.get("data", {})
     
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        response = await client.get(api_url, headers=headers)
-        
-        if response.status_code != 200:
-            raise HTTPException(status_code=500, detail="Erro ao conectar com servidor")
-        
-        data = response.json()
-        
-        if data.get("code") != 0:
-            raise HTTPException(status_code=400, detail="Video nao encontrado ou privado")
+    return {
+        "video_hd": video_data.get('hdplay') or video_data.get('play', ''),
+        "video_sd": video_data.get('play', ''),
+        "thumbnail": video_data.get("cover", ""),
+        "title": video_data.get("title", "Video do TikTok"),
+        "author": video_data.get("author", {}).get("nickname", ""),
+        "duration": video_data.get("duration", 0),
+        "video_id": str(video_data.get("id") or ""),
+    }
+
+async def fetch_via_tikwm_hedged(client: httpx.AsyncClient, url: str) -> dict:
+    """Se o tikwm demorar, dispara uma segunda consulta e usa a que responder primeiro"""
+    started = asyncio.Event()
+    tasks = [asyncio.create_task(fetch_via_tikwm(client, url, started))]
+    try:
+        # O prazo do hedge so conta o tempo no tikwm, nao a espera no semaforo/bucket
+        waiter = asyncio.create_task(started.wait())
+        try:
+            await asyncio.wait([tasks[0], waiter], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            waiter.cancel()
         
-        video_data = data.get("data", {})
+        done, _ = await asyncio.wait(tasks, timeout=TIKWM_HEDGE_DELAY)
+        # Sob carga (sem vaga ou sem token) a segunda chamada so pioraria a fila
+        if not done and not _TIKWM_SEM.locked() and _TIKWM_BUCKET.has_token():
+            tasks.append(asyncio.create_task(fetch_via_tikwm(client, url)))
         
-        return {
-            "video_hd": video_data.get('hdplay') or video_data.get('play', ''),
-            "video_sd": video_data.get('play', ''),
-            "thumbnail": video_data.get("cover", ""),
-            "title": video_data.get("title", "Video do TikTok"),
-            "author": video_data.get("author", {}).get("nickname", ""),
-            "duration": video_data.get("duration", 0),
-            "video_id": video_id,
-        }
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            # Le a excecao das tasks ja terminadas (mesmo as que perderam a corrida)
+            # para o asyncio nao logar "Task exception was never retrieved"
+            if task.done():
+                if not task.cancelled():
+                    task.exception()
+            else:
+                task.cancel()
+
+def video_cache_key(url: str):
+    """Retorna (chave de cache, video_id) para a URL; video_id e None em links curtos"""
+    # Links curtos (vm/vt.tiktok.com e tiktok.com/t/<codigo>) vao direto para o
+    # tikwm, que segue o redirect do lado dele; o ID vem na resposta da API
+    parts = urlsplit(url)
+    if parts.hostname in ("vm.tiktok.com", "vt.tiktok.com") or parts.path.startswith("/t/"):
+        return url, None
+    
+    video_id = extract_video_id(url)
+    if not video_id:
+        raise HTTPException(status_code=400, detail="Nao foi possivel extrair o ID do video")
+    return video_id, video_id
+
+async def get_tiktok_data(client: httpx.AsyncClient, url: str, cache_key: str) -> dict:
+    """Extrai dados do video usando tikwm.com API (chave vinda de video_cache_key)"""
+    failed = _FAILED_CACHE.get(cache_key)
+    if failed is not None:
+        status_code, detail = failed
+        raise HTTPException(status_code=status_code, detail=detail)
+    
+    try:
+        data = await fetch_via_tikwm_hedged(client, url)
+    except HTTPException as e:
+        # Guarda so status/mensagem: a excecao viva prenderia traceback, frames e resposta
+        _FAILED_CACHE[cache_key] = (e.status_code, e.detail)
+        raise
+    return data
 
 @app.post("/api/download", response_model=VideoResponse)
-async def download_video(request: VideoRequest):
+async def download_video(body: VideoRequest, request: Request):
     try:
-        url = request.url.strip()
+        url = body.url.strip()
         
         if not url:
             return VideoResponse(success=False, error="URL nao fornecida")
         
-        if "tiktok.com" not in url:
+        url = _normalize_url(url)
+        if not _is_tiktok_host(url):
             return VideoResponse(success=False, error="URL invalida. Use um link do TikTok.")
         
-        data = await get_tiktok_data(url)
+        # Cache guarda o JSON ja serializado: no hit nao passa pelo pydantic
+        cache_key, video_id = video_cache_key(url)
+        cached = _VIDEO_CACHE.get(cache_key)
+        if cached is not None:
+            return Response(content=cached, media_type="application/json")
+        
+        data = await get_tiktok_data(request.app.state.client, url, cache_key)
         
-        return VideoResponse(
+        result = VideoResponse(
             success=True,
             video_hd=data.get("video_hd"),
             video_sd=data.get("video_sd"),
@@ -123,6 +305,17 @@ async def download_video(request: VideoRequest):
             title=data.get("title"),
             author=data.get("author"),
         )
+        # So entra no cache o que ja passou pela validacao do pydantic
+        cached = orjson.dumps(result.model_dump())
+        # O ID que vale e o devolvido pelo tikwm; a chave tirada da URL so recebe
+        # a entrada se bater com ele (links curtos sao resolvidos pelo proprio tikwm)
+        tikwm_id = data["video_id"]
+        if tikwm_id:
+            _VIDEO_CACHE[tikwm_id] = cached
+        if video_id is None or video_id == tikwm_id:
+            _VIDEO_CACHE[cache_key] = cached
+        
+        return result
         
     except HTTPException as e:
         return VideoResponse(success=False, error=e.detail)
@@ -130,36 +323,60 @@ async def download_video(request: VideoRequest):
         return VideoResponse(success=False, error="Erro ao processar video. Tente novamente.")
 
 @app.get("/download")
-async def download_file(url: str, filename: str = "tiktok_video"):
+async def download_file(request: Request, url: str, filename: str = "tiktok_video"):
     """Proxy que baixa o video e entrega com nome .mp4"""
     if not url:
         raise HTTPException(status_code=400, detail="URL nao fornecida")
     
     # Limpar filename
-    safe_filename = re.sub(r'[^\w\-]', '_', filename)[:50]
+    safe_filename = filename[:50].translate(_FILENAME_TABLE)
     if not safe_filename:
         safe_filename = "tiktok_video"
     
+    client = request.app.state.download_client
+    
+    # Abre o upstream antes de responder para repassar o Content-Length
+    try:
+        upstream = await client.send(
+            client.build_request("GET", url, headers=DOWNLOAD_HEADERS),
+            stream=True,
+        )
+    except httpx.HTTPError:
+        raise HTTPException(status_code=502, detail="Erro ao baixar video")
+    
+    # URL assinada expirada ou invalida: nao repassa a pagina de erro como MP4
+    if upstream.status_code != 200:
+        await upstream.aclose()
+        raise HTTPException(status_code=502, detail="Erro ao baixar video")
+    
     headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-        "Referer": "https://www.tikwm.com/",
+        "Content-Disposition": f'attachment; filename="{safe_filename}.mp4"',
+        "Content-Type": "video/mp4",
     }
     
+    # Sem content-encoding os bytes brutos ja sao o MP4: evita a camada de descompressao
+    raw = "content-encoding" not in upstream.headers
+    if raw and "content-length" in upstream.headers:
+        headers["Content-Length"] = upstream.headers["content-length"]
+    
     async def stream_video():
-        async with httpx.AsyncClient(timeout=120.0, follow_redirects=True) as client:
-            async with client.stream("GET", url, headers=headers) as response:
-                async for chunk in response.aiter_bytes(chunk_size=65536):
-                    yield chunk
+        # finally fecha o upstream tambem em erro de leitura ou desconexao do cliente
+        try:
+            if raw:
+                chunks = upstream.aiter_raw(chunk_size=DOWNLOAD_CHUNK_SIZE)
+            else:
+                chunks = upstream.aiter_bytes(chunk_size=DOWNLOAD_CHUNK_SIZE)
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            await upstream.aclose()
     
     return StreamingResponse(
         stream_video(),
         media_type="video/mp4",
-        headers={
-            "Content-Disposition": f'attachment; filename="{safe_filename}.mp4"',
-            "Content-Type": "video/mp4",
-        }
+        headers=headers,
     )
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="uvloop", http="httptools")